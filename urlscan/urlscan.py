@@ -18,11 +18,19 @@
 
 """Contains the backend logic that scans messages for URLs and context."""
 
+from bisect import bisect_right
+import functools
 from html.parser import HTMLParser
 import locale
 import os
 import re
 from sys import getdefaultencoding
+import threading
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
 
 
 class Chunk:
@@ -36,20 +44,55 @@ class Chunk:
 
       url    - the URL to which this text is linked, or None
                if no URL link is present.'''
+    __slots__ = ('markup', 'url')
+
     def __init__(self, markup, url):
         self.markup = markup
         self.url = url
 
-    def __str__(self):
-        return f'Chunk(markup = {repr(self.markup)}, url= {repr(self.url)})'
-
     def __repr__(self):
-        return self.__str__()
-
-
-def isheadertag(tag):
-    """Determine if tag is a header """
-    return len(tag) == 2 and tag[0] == 'h' and tag[1].isdigit()
+        return f'Chunk(markup={self.markup!r}, url={self.url!r})'
+
+    __str__ = __repr__
+
+
+# Tables for HTMLChunker.handle_charref and handle_entityref. These only apply
+# if the parser is created with convert_charrefs=False. HTMLChunker keeps
+# HTMLParser's default of True, and lxml resolves references itself, so in
+# practice references are unescaped normally (&#8212; becomes an em dash, not
+# "--").
+EXTRACHARS = {8212: "--",
+              8217: "'",
+              8220: "``",
+              8221: "''",
+              8230: "..."}
+CHARREFS = {i: chr(i) for i in range(128)}
+CHARREFS.update(EXTRACHARS)
+
+ENTITIES = {'nbsp': ' ',
+            'lt': '<',
+            'gt': '>',
+            'amp': '&',
+            'ldquo': '``',
+            'rdquo': "''",
+            'apos': "'"}
+
+
+# Styled text uses the named attribute
+# msgtext:style1style2... where the styles
+# are always sorted in alphabetic order.
+# (if the text is in an anchor, substitute
+# "msgtext:anchor" for "msgtext")
+TAG_STYLES = {'b': frozenset(['bold']), 'i': frozenset(['italic'])}
+HEADER_STYLE = TAG_STYLES['b']
+
+UL_TAGS = ('*', '+', '-')
+
+HEADER_TAGS = frozenset(f'h{i}' for i in range(10))
+STARTEND_TAGS = frozenset(['p', 'br', 'li', 'img'])
+PARA_TAGS = frozenset(['p', 'br'])
+LIST_TAGS = frozenset(['ul', 'ol'])
+SS_TAGS = frozenset(['style', 'script'])
 
 
 class HTMLChunker(HTMLParser):
@@ -57,8 +100,28 @@ class HTMLChunker(HTMLParser):
     Each list represents a single paragraph."""
 
     def __init__(self):
+        # Start tag name -> handler(tag, attrs). Unlisted tags are ignored.
+        self.starttag_dispatch = {
+            'a': self.start_anchor,
+            'img': self.start_img,
+            'li': self.start_list_item,
+            **dict.fromkeys(LIST_TAGS, self.start_list),
+            **dict.fromkeys(TAG_STYLES, self.start_styled),
+            **dict.fromkeys(HEADER_TAGS, self.start_header),
+            **dict.fromkeys(PARA_TAGS, self.start_para),
+            **dict.fromkeys(SS_TAGS, self.start_style_or_script),
+        }
+
+        # Calls reset(), which sets up the remaining attributes.
         HTMLParser.__init__(self)
 
+    def reset(self):
+        """Discard all output and parser state so the chunker can be reused
+        for another message.
+
+        """
+        HTMLParser.reset(self)
+
         # This attribute is the current output list.
         self.rval = []
 
@@ -67,7 +130,9 @@ class HTMLChunker(HTMLParser):
         self.at_para_start = True
         self.trailing_space = False
 
-        self.style_stack = [set()]
+        # Entries are (styles, suffix) where suffix is the attribute name
+        # suffix for the set of styles, see push_style.
+        self.style_stack = [(frozenset(), '')]
         self.anchor_stack = [None]
         self.list_stack = []
         # either 'ul' or 'ol' entries.
@@ -75,23 +140,11 @@ class HTMLChunker(HTMLParser):
         # Ignore everything inside <style> and <script> elements
         self.in_style_or_script = False
 
-    # Styled text uses the named attribute
-    # msgtext:style1style2... where the styles
-    # are always sorted in alphabetic order.
-    # (if the text is in an anchor, substitute
-    # "msgtext:anchor" for "msgtext")
-    tag_styles = {'b': 'bold', 'i': 'italic'}
-
-    ul_tags = ['*', '+', '-']
-
-    def cur_url(self):
-        return self.anchor_stack[-1]
-
     def add_chunk(self, chunk):
         if self.at_para_start:
             self.rval.append([])
         elif self.trailing_space:
-            self.rval[-1].append(Chunk(' ', self.cur_url()))
+            self.rval[-1].append(Chunk(' ', self.anchor_stack[-1]))
 
         self.rval[-1].append(chunk)
         self.at_para_start = False
@@ -105,25 +158,34 @@ class HTMLChunker(HTMLParser):
         self.trailing_space = False
         if self.list_stack:
             self.add_chunk(Chunk(' ' * 3 * len(self.list_stack),
-                                 self.cur_url()))
+                                 self.anchor_stack[-1]))
 
     def end_list_para(self):
         if self.at_para_start:
             self.rval.append([])
         if self.list_stack:
+            url = self.anchor_stack[-1]
             tag = self.list_stack[-1][0]
             if tag == 'ul':
                 depth = len([t for t in self.list_stack if t[0] == tag])
-                ul_tags = HTMLChunker.ul_tags
-                chunk = Chunk(f"{ul_tags[depth % len(ul_tags)]}  ", self.cur_url())
+                chunk = Chunk(f"{UL_TAGS[depth % len(UL_TAGS)]}  ", url)
             else:
                 counter = self.list_stack[-1][1]
                 self.list_stack[-1] = (tag, counter + 1)
-                chunk = Chunk(f"{counter:2d}.", self.cur_url())
+                chunk = Chunk(f"{counter:2d}.", url)
             self.add_chunk(chunk)
         else:
             self.end_para()
 
+    def push_style(self, styles):
+        """Push the current styles plus styles onto the style stack, along
+        with the attribute name suffix (":bolditalic") used by handle_data.
+
+        """
+        styles = self.style_stack[-1][0] | styles
+        suffix = ':' + ''.join(sorted(styles)) if styles else ''
+        self.style_stack.append((styles, suffix))
+
     def findattr(self, attrs, searchattr):
         for attr, val in attrs:
             if attr == searchattr:
@@ -131,120 +193,165 @@ class HTMLChunker(HTMLParser):
 
         return None
 
+    def start_anchor(self, tag, attrs):
+        self.anchor_stack.append(self.findattr(attrs, 'href'))
+
+    def start_list(self, tag, attrs):
+        self.list_stack.append((tag, 1))
+        self.end_para()
+
+    def start_styled(self, tag, attrs):
+        self.push_style(TAG_STYLES[tag])
+
+    def start_header(self, tag, attrs):
+        self.push_style(HEADER_STYLE)
+
+    def start_para(self, tag, attrs):
+        self.end_para()
+
+    def start_img(self, tag, attrs):
+        # Since we expect HTML *email*, image links
+        # should be external (naja?)
+        alt = self.findattr(attrs, 'alt')
+        if alt is None:
+            alt = '[IMG]'
+        src = self.findattr(attrs, 'src')
+        if src is not None and not src.startswith(('http://', 'https://')):
+            src = None
+
+        if src is not None:
+            self.anchor_stack.append(src)
+            self.handle_data(alt)
+            del self.anchor_stack[-1]
+        else:
+            self.handle_data(alt)
+
+    def start_list_item(self, tag, attrs):
+        self.end_list_para()
+
+    def start_style_or_script(self, tag, attrs):
+        self.in_style_or_script = True
+
     def handle_starttag(self, tag, attrs):
-        if tag == 'a':
-            self.anchor_stack.append(self.findattr(attrs, 'href'))
-        elif tag in ('ul', 'ol'):
-            self.list_stack.append((tag, 1))
-            self.end_para()
-        elif tag in HTMLChunker.tag_styles:
-            self.style_stack.append(self.style_stack[-1] |
-                                    set([HTMLChunker.tag_styles[tag]]))
-        elif isheadertag(tag):
-            self.style_stack.append(self.style_stack[-1] | set(['bold']))
-        elif tag in ('p', 'br'):
-            self.end_para()
-        elif tag == 'img':
-            # Since we expect HTML *email*, image links
-            # should be external (naja?)
-            alt = self.findattr(attrs, 'alt')
-            if alt is None:
-                alt = '[IMG]'
-            src = self.findattr(attrs, 'src')
-            if src is not None and not src.startswith(('http://', 'https://')):
-                src = None
-
-            if src is not None:
-                self.anchor_stack.append(src)
-                self.handle_data(alt)
-                del self.anchor_stack[-1]
-            else:
-                self.handle_data(alt)
-        elif tag == 'li':
-            self.end_list_para()
-        elif tag in ('style', 'script'):
-            self.in_style_or_script = True
+        handler = self.starttag_dispatch.get(tag)
+        if handler is not None:
+            handler(tag, attrs)
 
     def handle_startendtag(self, tag, attrs):
-        if tag in set(['p', 'br', 'li', 'img']):
+        if tag in STARTEND_TAGS:
             self.handle_starttag(tag, attrs)
 
     def handle_endtag(self, tag):
         if tag == 'a':
             if len(self.anchor_stack) > 1:
                 del self.anchor_stack[-1]
-        elif tag in HTMLChunker.tag_styles:
+        elif tag in TAG_STYLES:
             if len(self.style_stack) > 1:
                 del self.style_stack[-1]
-        elif tag in ('ul', 'ol'):
+        elif tag in LIST_TAGS:
             if len(self.list_stack) > 0:
                 del self.list_stack[-1]
             self.end_para()
-        elif isheadertag(tag):
+        elif tag in HEADER_TAGS:
             if len(self.style_stack) > 1:
                 del self.style_stack[-1]
             self.end_para()
-        elif tag in ('style', 'script'):
+        elif tag in SS_TAGS:
             self.in_style_or_script = False
 
     def handle_data(self, data):
         if self.in_style_or_script:
             return
-        future_trailing_space = False
-        if data:
-            if data[0].isspace():
-                self.trailing_space = True
-            if data[-1].isspace():
-                future_trailing_space = True
+        if data[:1].isspace():
+            self.trailing_space = True
+        future_trailing_space = data[-1:].isspace()
         data = ' '.join(data.split())
-        if self.anchor_stack[-1] is None:
+        url = self.anchor_stack[-1]
+        if url is None:
             style = 'msgtext'
         else:
             style = 'anchor'
-        if self.style_stack[-1]:
-            stylelist = list(self.style_stack[-1])
-            stylelist.sort()
-            style = style + ':' + ''.join(stylelist)
+        style += self.style_stack[-1][1]
 
-        self.add_chunk(Chunk((style, data), self.cur_url()))
+        self.add_chunk(Chunk((style, data), url))
         self.trailing_space = future_trailing_space
 
-    extrachars = {8212: "--",
-                  8217: "'",
-                  8220: "``",
-                  8221: "''",
-                  8230: "..."}
-
     def handle_charref(self, name):
-        if name[0] == 'x':
+        if name[:1] == 'x':
             char = int(name[1:], 16)
         else:
             char = int(name)
-        if char < 128:
-            name = chr(char)
-        elif char in HTMLChunker.extrachars:
-            name = HTMLChunker.extrachars[char]
-        else:
-            name = f"&#{name};"
-        self.handle_data(name)
-
-    entities = {'nbsp': ' ',
-                'lt': '<',
-                'gt': '>',
-                'amp': '&',
-                'ldquo': '``',
-                'rdquo': "''",
-                'apos': "'"}
+        self.handle_data(CHARREFS.get(char) or f"&#{name};")
 
     def handle_entityref(self, name):
-        if name in HTMLChunker.entities:
-            self.handle_data(HTMLChunker.entities[name])
+        if name in ENTITIES:
+            self.handle_data(ENTITIES[name])
         else:
             # If you see a reference, it needs to be
             # added above.
             self.handle_data(f"&{name};")
 
 
+class LXMLTarget:
+    """Parser target that forwards the events from lxml's (libxml2) HTML parser
+    to the matching HTMLChunker handlers. libxml2 resolves character and entity
+    references itself and reports the text around them in pieces, so adjacent
+    data is collected and handed on as one string.
+
+    Unlike HTMLParser, lxml reports a valueless attribute (<a href>) as ''
+    rather than None.
+
+    """
+
+    def __init__(self, chunker):
+        self.chunker = chunker
+        self.text = []
+
+    def flush(self):
+        if self.text:
+            self.chunker.handle_data(''.join(self.text))
+            self.text = []
+
+    def start(self, tag, attrib):
+        self.flush()
+        self.chunker.handle_starttag(tag, list(attrib.items()))
+
+    def end(self, tag):
+        self.flush()
+        self.chunker.handle_endtag(tag)
+
+    def data(self, data):
+        self.text.append(data)
+
+    def close(self):
+        self.flush()
+
+
+def feed_html(chunker, mesg):
+    """Feed an html message through an HTMLChunker. Tokenizing is done by lxml
+    if it is installed, otherwise by the chunker's own HTMLParser. Messages
+    lxml can't take as is (NUL characters, which it replaces, or lone
+    surrogates, which it can't encode) also go through HTMLParser.
+
+    """
+    if etree is not None and '\x00' not in mesg:
+        parser = etree.HTMLParser(target=LXMLTarget(chunker))
+        try:
+            parser.feed(mesg)
+        except UnicodeEncodeError:
+            chunker.reset()
+        else:
+            try:
+                parser.close()
+            except etree.XMLSyntaxError:
+                # Raised for empty documents. The parser recovers from
+                # anything else, and all events have been delivered by now.
+                pass
+            return
+    chunker.feed(mesg)
+    chunker.close()
+
+
 URLINTERNALPATTERN = r'[\[\]{}()@\w/\\\-%?!&.=:;+,#~*]'
 URLTRAILINGPATTERN = r'[{}(@\w/\-%&=+#$]'
 HTTPURLPATTERN = (r'(?:(https?|file|ftps?)://' + URLINTERNALPATTERN +
@@ -255,139 +362,200 @@ HTTPURLPATTERN = (r'(?:(https?|file|ftps?)://' + URLINTERNALPATTERN +
 def load_tlds():
     """Load all legal TLD extensions from assets
 
+    Returns: frozenset of lowercase TLDs
+
     """
     file = os.path.join(os.path.dirname(__file__),
                         'assets',
                         'tlds-alpha-by-domain.txt')
     with open(file, encoding=getdefaultencoding()) as fobj:
-        return [elem for elem in fobj.read().lower().splitlines()[1:]
-                if "--" not in elem]
+        return frozenset(elem for elem in fobj.read().lower().splitlines()[1:]
+                         if "--" not in elem)
+
+
+TLDS_SET = load_tlds()
+# Candidate dotted names at the end of the text. Whether the final segment is
+# a known TLD is checked separately against TLDS_SET, see guessed_url_valid().
+GUESSEDNAMEPATTERN = r'[\w\-%]+(?:\.[\w\-%]+)+'
+GUESSEDURLPATTERN = r'(?P<guessed>' + GUESSEDNAMEPATTERN + r'$)'
+
+
+def compile_urlre(guessedpattern):
+    """Build the URL regex around the given guessed-URL pattern.
 
+    """
+    return re.compile(r'(?:<(?:URL:)?)?(' + HTTPURLPATTERN + '|' +
+                      guessedpattern +
+                      r'|(?P<email>(mailto:)?[\w\-.]+@[\w\-.]*[\w\-]))>?',
+                      flags=re.U)
+
+
+URLRE = compile_urlre(GUESSEDURLPATTERN)
+# Same as URLRE, but guessed URLs may end at any line end, for scanning a
+# whole message at once in extracturls.
+LINEURLRE = compile_urlre(r'(?P<guessed>' + GUESSEDNAMEPATTERN +
+                          r'(?=[\r\n]|\Z))')
+
+
+def guessed_url_valid(match):
+    """Check that a URLRE match guessed from a bare dotted name ends in a known
+    TLD. Matches from the other branches are always valid.
+
+    """
+    guessed = match.group('guessed')
+    return not guessed or guessed.rsplit('.', 1)[-1] in TLDS_SET
+
+
+def urlmatch(text):
+    """Match URLRE at the start of text, rejecting unknown TLDs.
+
+    """
+    match = URLRE.match(text)
+    return match is not None and guessed_url_valid(match)
 
-TLDS = load_tlds()
-GUESSEDURLPATTERN = (r'(?:[\w\-%]+(?:\.[\w\-%]+)*\.(?:' +
-                     '|'.join(TLDS) + ')$)')
-URLRE = re.compile(r'(?:<(?:URL:)?)?(' + HTTPURLPATTERN + '|' +
-                   GUESSEDURLPATTERN +
-                   r'|(?P<email>(mailto:)?[\w\-.]+@[\w\-.]*[\w\-]))>?',
-                   flags=re.U)
 
 # Poor man's test cases.
-assert URLRE.match('<URL:http://linuxtoday.com>')
-assert URLRE.match('http://linuxtoday.com')
+assert urlmatch('<URL:http://linuxtoday.com>')
+assert urlmatch('http://linuxtoday.com')
 assert re.compile(GUESSEDURLPATTERN).match('example.biz')
-assert URLRE.match('example.biz')
-assert URLRE.match('linuxtoday.com')
-assert URLRE.match('master.wizard.edu')
-assert URLRE.match('blah.bar.info')
-assert URLRE.match('goodpr.org')
-assert URLRE.match('http://github.com/firecat53/ürlscan')
-assert URLRE.match('https://Schöne_Grüße.es/test')
-assert URLRE.match('http://www.pantherhouse.com/newshelton/my-wife-thinks-i’m-a-swan/')
-assert not URLRE.match('blah..org')
-assert URLRE.match('http://www.testurl.zw')
-assert URLRE.match('http://www.testurl.smile')
-assert URLRE.match('testurl.smile.smile')
-assert URLRE.match('testurl.biz.smile.zw')
-assert not URLRE.match('example..biz')
-assert not URLRE.match('blah.baz.obviouslynotarealdomain')
-assert URLRE.match('http://[2a07:3500:11a0:320::22]:8080')
+assert urlmatch('example.biz')
+assert urlmatch('linuxtoday.com')
+assert urlmatch('master.wizard.edu')
+assert urlmatch('blah.bar.info')
+assert urlmatch('goodpr.org')
+assert urlmatch('http://github.com/firecat53/ürlscan')
+assert urlmatch('https://Schöne_Grüße.es/test')
+assert urlmatch('http://www.pantherhouse.com/newshelton/my-wife-thinks-i’m-a-swan/')
+assert not urlmatch('blah..org')
+assert urlmatch('http://www.testurl.zw')
+assert urlmatch('http://www.testurl.smile')
+assert urlmatch('testurl.smile.smile')
+assert urlmatch('testurl.biz.smile.zw')
+assert not urlmatch('example..biz')
+assert not urlmatch('blah.baz.obviouslynotarealdomain')
+assert urlmatch('http://[2a07:3500:11a0:320::22]:8080')
+
+
+@functools.lru_cache(maxsize=32)
+def _get_regex(pat):
+    """Compile a custom URL regex, caching the result by pattern string.
 
+    """
+    return re.compile(pat, flags=re.U)
 
-def parse_text_urls(mesg, regex=None):
-    """Parse a block of text, splitting it into its url and non-url
-    components."""
 
-    rval = []
+def compile_regex(regex):
+    """Return a compiled pattern for a custom regex, which may be given either
+    as a string or an already compiled pattern. Returns None if no custom regex
+    was given.
 
-    loc = 0
+    """
+    if not regex:
+        return None
+    if isinstance(regex, re.Pattern):
+        return regex
+    return _get_regex(regex)
 
-    global URLRE
 
-    if regex:
-        URLRE = re.compile(regex)
-
-    for match in URLRE.finditer(mesg):
-        if loc < match.start():
-            rval.append(Chunk(mesg[loc:match.start()], None))
-        # Turn email addresses into mailto: links
-        if regex:
-            rval.append(Chunk(None, match.group(0)))
+def find_urls(mesg, urlre=URLRE):
+    """Return the URLRE (or urlre) matches in mesg, leaving out guessed URLs
+    with an unknown TLD.
+
+    """
+    return [match for match in urlre.finditer(mesg) if guessed_url_valid(match)]
+
+
+def url_chunks(mesg, matches, custom=False, start=0, end=None):
+    """Split mesg[start:end] into its url and non-url components, given the
+    URL matches found within that range. If custom is True the matches come
+    from a custom regex and are used as is.
+
+    """
+    if end is None:
+        end = len(mesg)
+
+    # Most lines don't contain a URL at all.
+    if not matches:
+        return [Chunk(mesg[start:end], None)] if start < end else []
+
+    rval = []
+    append = rval.append
+    loc = start
+
+    for match in matches:
+        mstart, mend = match.span()
+        if loc < mstart:
+            append(Chunk(mesg[loc:mstart], None))
+        if custom:
+            append(Chunk(None, match.group(0)))
         else:
+            # Turn email addresses into mailto: links
             email = match.group("email")
             if email and "mailto" not in email:
-                mailto = f"mailto:{email}"
+                append(Chunk(None, f"mailto:{email}"))
             else:
-                mailto = match.group(1)
-            rval.append(Chunk(None, mailto))
-        loc = match.end()
+                append(Chunk(None, match.group(1)))
+        loc = mend
 
-    if loc < len(mesg):
-        rval.append(Chunk(mesg[loc:], None))
+    if loc < end:
+        append(Chunk(mesg[loc:end], None))
 
     return rval
 
 
-def extract_with_context(lst, pred, before_context, after_context):
-    """Extract URL and context from a given chunk.
+def parse_text_urls(mesg, regex=None):
+    """Parse a block of text, splitting it into its url and non-url
+    components."""
+
+    regex = compile_regex(regex)
+    if regex:
+        return url_chunks(mesg, list(regex.finditer(mesg)), custom=True)
+    return url_chunks(mesg, find_urls(mesg))
+
+
+def context_ranges(flags, before_context, after_context):
+    """Compute the (start, end) slices extracted by extract_with_context.
+
+    Args: flags - sequence of 0/1 values, 1 for each element containing a URL
+          before_context, after_context - amount of context around matches
+    Returns: list of (start, end) tuples
 
     """
-    rval = []
+    ranges = []
+    length = len(flags)
+    # Matches separated by at most this many other elements share a range.
+    merge_gap = after_context + max(before_context, 1)
+    floor = 0
+    idx = 0
+    while idx < length:
+        if not flags[idx]:
+            idx += 1
+            continue
+        start = max(floor, idx - before_context - 1)
+        while True:
+            nxt = idx + 1
+            while nxt < length and not flags[nxt]:
+                nxt += 1
+            gap = nxt - idx - 1
+            if nxt == length or gap > merge_gap:
+                break
+            idx = nxt
+        end = idx + 1 + min(after_context, gap)
+        ranges.append((start, end))
+        floor = end
+        idx = nxt
+    return ranges
 
-    start = 0
-    length = 0
-    while start < len(lst):
-        usedfirst = False
-        usedlast = False
-        # Extend to the next match.
-        while start + length < len(lst) and length < before_context + 1 \
-                and not pred(lst[start + length]):
-            length += 1
-
-        # Slide to the next match.
-        while start + length < len(lst) and not pred(lst[start + length]):
-            start += 1
-
-        # If there was no next match, abort here (it's easier
-        # to do this than to try to detect this case later).
-        if start + length == len(lst):
-            break
 
-        # Now extend repeatedly until we can't find anything.
-        while start + length < len(lst) and pred(lst[start + length]):
-            extendlength = 1
-            # Read in the 'after' context and see if it holds a URL.
-            while extendlength < after_context + 1 and start + length + \
-                    extendlength < len(lst) and \
-                    not pred(lst[start + length + extendlength]):
-                extendlength += 1
-            length += extendlength
-            if start + length < len(lst) and not pred(lst[start + length]):
-                # Didn't find a matching line, so we either
-                # hit the end or extended to after_context + 1..
-                #
-                # Now read in possible 'before' context
-                # from the next URL; if we don't find one,
-                # we discard the readahead.
-                extendlength = 1
-                while extendlength < before_context and start + length + \
-                        extendlength < len(lst) and \
-                        not pred(lst[start + length + extendlength]):
-                    extendlength += 1
-                if start + length + extendlength < len(lst) and \
-                        pred(lst[start + length + extendlength]):
-                    length += extendlength
-
-        if length > 0 and start + length <= len(lst):
-            if start == 0:
-                usedfirst = True
-            if start + length == len(lst):
-                usedlast = True
-            rval.append((lst[start:start + length], usedfirst, usedlast))
-
-        start += length
-        length = 0
-    return rval
+def extract_with_context(lst, pred, before_context, after_context):
+    """Extract URL and context from a given chunk.
+
+    """
+    flags = bytearray(1 if pred(i) else 0 for i in lst)
+    length = len(lst)
+    return [(lst[start:end], start == 0, end == length)
+            for start, end in context_ranges(flags, before_context,
+                                             after_context)]
 
 
 NLRE = re.compile('\r\n|\n|\r')
@@ -399,8 +567,6 @@ def extracturls(mesg, regex=None):
     objects, corresponding to the contextual regions extracted from the string.
 
     """
-    lines = NLRE.split(mesg)
-
     # The number of lines of context above to provide.
     # above_context = 1
     # The number of lines of context below to provide.
@@ -412,7 +578,26 @@ def extracturls(mesg, regex=None):
     # lines with more than one entry or one entry that's
     # a URL are the only lines containing URLs.
 
-    linechunks = [parse_text_urls(i, regex=regex) for i in lines]
+    regex = compile_regex(regex)
+    if regex:
+        # A custom regex might match across line ends, so it is applied to
+        # each line separately.
+        linechunks = [parse_text_urls(i, regex=regex)
+                      for i in NLRE.split(mesg)]
+    else:
+        # URLRE never matches a line end, so scan the whole message at once
+        # with LINEURLRE and sort the matches into their lines.
+        starts = [0]
+        ends = []
+        for match in NLRE.finditer(mesg):
+            ends.append(match.start())
+            starts.append(match.end())
+        ends.append(len(mesg))
+        linematches = [[] for _ in starts]
+        for match in find_urls(mesg, LINEURLRE):
+            linematches[bisect_right(starts, match.start()) - 1].append(match)
+        linechunks = [url_chunks(mesg, matches, start=start, end=end)
+                      for start, end, matches in zip(starts, ends, linematches)]
 
     return extract_with_context(linechunks,
                                 lambda chunk: len(chunk) > 1 or
@@ -420,13 +605,27 @@ def extracturls(mesg, regex=None):
                                 1, 1)
 
 
+# Each thread reuses one HTMLChunker for all of its html parts.
+CHUNKERS = threading.local()
+
+
+def get_chunker():
+    """Return this thread's HTMLChunker, creating it on first use.
+
+    """
+    chunker = getattr(CHUNKERS, 'chunker', None)
+    if chunker is None:
+        chunker = CHUNKERS.chunker = HTMLChunker()
+    return chunker
+
+
 def extracthtmlurls(mesg):
     """Extract URLs with context from html type message. Similar to extracturls.
 
     """
-    chunk = HTMLChunker()
-    chunk.feed(mesg)
-    chunk.close()
+    chunk = get_chunker()
+    chunk.reset()
+    feed_html(chunk, mesg)
     # above_context = 1
     # below_context = 1
 
@@ -483,9 +682,10 @@ def set_charset(message):
     code = locale.getpreferredencoding()
     if code not in enc_list:
         enc_list.insert(0, code)
+    raw = message.as_bytes()
     for enc in enc_list:
         try:
-            message.as_bytes().decode(enc)
+            raw.decode(enc)
         except (UnicodeDecodeError, UnicodeError):
             continue
         else:
@@ -508,6 +708,7 @@ def msgurls(msg, urlidx=1, regex=None, headers=False):
     # one subpart in the future (e.g., for
     # multipart/alternative).  Actually, I might even add
     # a browser for the message structure?
+    regex = compile_regex(regex)
     if headers is True:
         for part in msgheaders(set_charset(msg)):
             for chunk in extracturls(part):